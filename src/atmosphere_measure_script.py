@@ -1,22 +1,25 @@
-import csv
-
 import krpc
+import numpy as np
 
 print('Connecting...')
 client = krpc.connect()
 vessel = client.space_center.active_vessel
 kerbin = client.space_center.bodies['Kerbin']
+reference_frame = kerbin.reference_frame
 
-result = [['Altitude', 'Pressure', 'Density', 'Temperature']]
+altitudes = np.arange(0, 70000, 100, dtype=np.float64)
+result = np.empty((altitudes.size, 4), dtype=np.float64)
+result[:, 0] = altitudes
 
 print('Recording...')
-for altitude in range(0, 70000, 100):
-    result.append([altitude, kerbin.pressure_at(altitude), kerbin.density_at(altitude),
-                   kerbin.temperature_at((600000 + altitude, 0, 0), kerbin.reference_frame)])
+for row, altitude in zip(result, altitudes.tolist()):
+    row[1] = kerbin.pressure_at(altitude)
+    row[2] = kerbin.density_at(altitude)
+    row[3] = kerbin.temperature_at((600000 + altitude, 0, 0), reference_frame)
 
 print('Writing file "density.csv"')
-with open('density.csv', 'w', newline='') as file:
-    writer = csv.writer(file)
-    writer.writerows(result)
+# Whole-number altitudes, shortest round-trip repr for the measurements
+np.savetxt('density.csv', result, fmt=['%d', '%s', '%s', '%s'], delimiter=',',
+           header='Altitude,Pressure,Density,Temperature', comments='')
 
 print('Finished!')
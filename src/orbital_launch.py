@@ -1,16 +1,32 @@
 import csv
+import os
+import struct
 import time
-from math import sqrt, pow
-from enum import Enum
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from math import sqrt
+from enum import IntEnum
+from types import MappingProxyType
 import krpc
 
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional, numeric helpers then run as plain Python
+    def njit(*args, **kwargs):
+        # Used bare as @njit or with options as @njit(...)
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda function: function
 
+
+@njit(cache=True, fastmath=True)
 def magnitude(vector3d):
     v = vector3d
-    return sqrt(pow(v[0], 2) + pow(v[1], 2) + pow(v[2], 2))
+    return sqrt(v[0] * v[0] + v[1] * v[1] + v[2] * v[2])
 
 
-class FlightPhase(Enum):
+class FlightPhase(IntEnum):
     LAUNCHPAD = 1
     INITIAL_CLIMB = 2
     INITIAL_TURN = 3
@@ -26,23 +42,38 @@ class FlightPhase(Enum):
 
 
 class Timer:
+    __slots__ = ('start_time', 'duration')
+
     def __init__(self, duration):
-        self.start_time = time.time()
+        self.start_time = time.monotonic()
         self.duration = duration
 
     def elapsed(self):
-        if time.time() > self.start_time + self.duration:
+        if time.monotonic() > self.start_time + self.duration:
             return True
         return False
 
 
+TelemetrySample = namedtuple('TelemetrySample', ['altitude', 'apoapsis', 'thrust', 'speed_mode', 'ut', 'drag', 'tas',
+                                                 'mach', 'density', 'dynamic_pressure', 'temperature'])
+
+
 class Telemetry:
     """Connects to kRPC to get KSP streams of values and interesting objects such as vessel, control, flight, etc."""
+    __slots__ = ('client', 'do_record', '_record_file', '_io_pool', 'sc', 'kerbin', 'vessel', 'flight', 'autopilot',
+                 'control', '_streams', '_sample', '_last_sample', 'altitude', 'apoapsis', 'thrust', 'speed_mode',
+                 'start_time', 'elapsed')
+
+    # Telemetry is logged as raw doubles during the flight and only turned into CSV once recording stops
+    _record_row = struct.Struct('<8d')
+
     def __init__(self):
         self.client = krpc.connect()
 
         self.do_record = False
-        self.record = [['ut', 'altitude', 'drag', 'TAS', 'mach', 'density', 'Q', 'temperature']]
+        self._record_file = None
+        # Single worker: console and file output keep their order but stay off the control loop
+        self._io_pool = ThreadPoolExecutor(max_workers=1)
 
         self.sc = self.client.space_center
         self.kerbin = self.sc.bodies['Kerbin']
@@ -51,125 +82,187 @@ class Telemetry:
         self.autopilot = self.vessel.auto_pilot
         self.control = self.vessel.control
 
-        self.ut_stream = self.client.add_stream(getattr, self.sc, 'ut')
-        self.altitude_stream = self.client.add_stream(getattr, self.flight, 'mean_altitude')
-        self.apoapsis_stream = self.client.add_stream(getattr, self.vessel.orbit, 'apoapsis_altitude')
-        self.drag_stream = self.client.add_stream(getattr, self.flight, 'drag')
-        self.tas_stream = self.client.add_stream(getattr, self.flight, 'true_air_speed')
-        self.mach_stream = self.client.add_stream(getattr, self.flight, 'mach')
-        self.density_stream = self.client.add_stream(getattr, self.flight, 'atmosphere_density')
-        self.dynamic_pressure_stream = self.client.add_stream(getattr, self.flight, 'dynamic_pressure')
-        self.temperature_stream = self.client.add_stream(getattr, self.flight, 'static_air_temperature')
+        # In the same order as the TelemetrySample fields
+        self._streams = (
+            self.client.add_stream(getattr, self.flight, 'mean_altitude'),
+            self.client.add_stream(getattr, self.vessel.orbit, 'apoapsis_altitude'),
+            self.client.add_stream(getattr, self.vessel, 'thrust'),
+            self.client.add_stream(getattr, self.control, 'speed_mode'),
+            self.client.add_stream(getattr, self.sc, 'ut'),
+            self.client.add_stream(getattr, self.flight, 'drag'),
+            self.client.add_stream(getattr, self.flight, 'true_air_speed'),
+            self.client.add_stream(getattr, self.flight, 'mach'),
+            self.client.add_stream(getattr, self.flight, 'atmosphere_density'),
+            self.client.add_stream(getattr, self.flight, 'dynamic_pressure'),
+            self.client.add_stream(getattr, self.flight, 'static_air_temperature'),
+        )
+        # Well above the 10 Hz control loop: the server paces pushes on its own frame times, a cap at the loop rate
+        # would drift against it and leave the loop reading stale values
+        for stream in self._streams:
+            stream.rate = 50
+        # A new snapshot of all the streams is taken each time a stream update has been processed, rate limited
+        # streams are pushed separately so a snapshot may mix values from neighbouring server frames
+        self._sample = None
+        self._last_sample = None
+        self._take_sample()
+        self.client.add_stream_update_callback(self._take_sample)
+        # With Numba the first call compiles magnitude, done here rather than on the first control tick
+        magnitude(self._current_sample().drag)
 
         self.altitude = 0
         self.apoapsis = 0
+        self.thrust = 0
+        self.speed_mode = None
         self.start_time = 0
         self.elapsed = 0
 
+    def _take_sample(self):
+        """Called by kRPC on its stream thread after each stream update"""
+        try:
+            self._sample = TelemetrySample._make(stream() for stream in self._streams)
+        except Exception as error:
+            # Raising here would kill kRPC's stream thread and freeze every stream, the error is raised again on
+            # the control thread instead
+            self._sample = error
+
+    def _current_sample(self):
+        sample = self._sample
+        if isinstance(sample, Exception):
+            raise sample
+        return sample
+
     def init_time(self):
-        self.start_time = self.ut_stream()
+        self.start_time = self._current_sample().ut
 
     def update(self):
+        sample = self._current_sample()
+        altitude, apoapsis, thrust, speed_mode, ut, drag, tas, mach, density, q, temperature = sample
         # Required for flying
-        self.altitude = self.altitude_stream()
-        self.apoapsis = self.apoapsis_stream()
-
-        if self.do_record:
-            # Only required for telemetry
-            self.elapsed = self.ut_stream() - self.start_time
-            drag = magnitude(self.drag_stream())
-            tas = self.tas_stream()
-            mach = self.mach_stream()
-            density = self.density_stream()
-            q = self.dynamic_pressure_stream()
-            temperature = self.temperature_stream()
-            self.record.append([self.elapsed, self.altitude, drag, tas, mach, density, q, temperature])
+        self.altitude = altitude
+        self.apoapsis = apoapsis
+        self.thrust = thrust
+        self.speed_mode = speed_mode
+
+        # Only required for telemetry, a row is recorded once per snapshot
+        if self.do_record and sample is not self._last_sample:
+            self._last_sample = sample
+            self.elapsed = ut - self.start_time
+            self._record_file.write(self._record_row.pack(self.elapsed, self.altitude, magnitude(drag), tas, mach,
+                                                          density, q, temperature))
+
+    def log(self, *values):
+        """Prints values from the I/O thread"""
+        self._io_pool.submit(print, *values)
+
+    def start_recording(self):
+        """Opens the atmospheric telemetry log, rows are then written on each update"""
+        self._record_file = open('atmospheric.bin', 'wb', buffering=65536)
+        self.do_record = True
 
     def stop_recording(self):
         self.do_record = False
-        self._write_atmospheric_record()
+        self._io_pool.submit(self._write_atmospheric_record)
 
     def _write_atmospheric_record(self):
         print('Writing atmospheric telemetry report...', sep=' ')
-        with open('atmospheric.csv', 'w', newline='') as file:
+        self._record_file.close()
+        self._record_file = None
+        with open('atmospheric.bin', 'rb') as log, open('atmospheric.csv', 'w', newline='') as file:
             writer = csv.writer(file)
-            writer.writerows(self.record)
+            writer.writerow(['ut', 'altitude', 'drag', 'TAS', 'mach', 'density', 'Q', 'temperature'])
+            writer.writerows(self._record_row.iter_unpack(log.read()))
+        os.remove('atmospheric.bin')
         print('Done!')
 
 
 class OrbitalLaunch:
+    __slots__ = ('telemetry', 'phase', 'meco_timer_1', 'meco_timer_2', '_transitions', '_control', '_surface_mode')
+
     def __init__(self):
         self.telemetry = Telemetry()
+        self._control = self.telemetry.control
+        self._surface_mode = self.telemetry.sc.SpeedMode.surface
         self.phase = FlightPhase.LAUNCHPAD
         self._change_flight_law()
         self.meco_timer_1 = None
         self.meco_timer_2 = None
 
+        telemetry = self.telemetry
+        # Current phase -> (condition on altitude and apoapsis to leave it, next phase)
+        self._transitions = MappingProxyType({
+            FlightPhase.LAUNCHPAD: (lambda altitude, apoapsis: True, FlightPhase.INITIAL_CLIMB),
+            FlightPhase.INITIAL_CLIMB: (lambda altitude, apoapsis: altitude > 100, FlightPhase.INITIAL_TURN),
+            FlightPhase.INITIAL_TURN: (lambda altitude, apoapsis: altitude > 500, FlightPhase.GRAVITY_TURN),
+            FlightPhase.GRAVITY_TURN: (lambda altitude, apoapsis: telemetry.thrust < 1, FlightPhase.MECO),
+            FlightPhase.MECO: (lambda altitude, apoapsis: self.meco_timer_1.elapsed(),
+                               FlightPhase.MAIN_STAGE_SEPARATION),
+            FlightPhase.MAIN_STAGE_SEPARATION: (lambda altitude, apoapsis: self.meco_timer_2.elapsed(),
+                                                FlightPhase.SUBORBITAL_ACCELERATION),
+            FlightPhase.SUBORBITAL_ACCELERATION: (lambda altitude, apoapsis: apoapsis > 75000, FlightPhase.SECO),
+            FlightPhase.SECO: (lambda altitude, apoapsis: altitude > 70000,
+                               FlightPhase.IN_SPACE_TOWARDS_CIRCULARIZATION),
+        })
+
     @property
     def phase_name(self):
-        return str(self.phase).removeprefix('FlightPhase.')
+        return self.phase.name
 
     def run(self):
-        self.telemetry.init_time()
+        telemetry = self.telemetry
+        telemetry.init_time()
+        # Looked up once, the loop body then only uses locals
+        update = telemetry.update
+        check_phase = self._check_phase
+        change_flight_law = self._change_flight_law
+        control = self._control
+        surface_mode = self._surface_mode
+        monotonic = time.monotonic
+        sleep = time.sleep
+
+        next_tick = monotonic()
         while True:
-            start_time = time.time()
-            self.telemetry.control.speed_mode = self.telemetry.sc.SpeedMode.surface
-            self.telemetry.update()
-            altitude = self.telemetry.altitude
-            apoapsis = self.telemetry.apoapsis
+            update()
+            altitude = telemetry.altitude
+            apoapsis = telemetry.apoapsis
 
-            if self._check_phase(altitude, apoapsis):
-                self._change_flight_law()
+            # KSP switches the navball to orbit mode on its own during the ascent, SAS prograde must stay on the
+            # surface one, the stream makes this check free until the mode actually changes
+            if telemetry.speed_mode != surface_mode:
+                control.speed_mode = surface_mode
 
-            if self.telemetry.do_record and altitude > 70000:
-                self.telemetry.stop_recording()
+            if check_phase(altitude, apoapsis):
+                change_flight_law()
 
-            end_time = time.time()
-            idle_time = 0.1 - (end_time - start_time)
+            if telemetry.do_record and altitude > 70000:
+                telemetry.stop_recording()
+
+            # Ticks are scheduled on a fixed 10 Hz grid so a slow iteration does not shift the following ones,
+            # unless it overran the next tick too, then the grid restarts from now
+            next_tick += 0.1
+            idle_time = next_tick - monotonic()
             if idle_time > 0:
-                time.sleep(idle_time)
+                sleep(idle_time)
+            else:
+                next_tick = monotonic()
 
     def _check_phase(self, altitude, apoapsis):
         """Handles flight phase against conditions
 
         :return False if no change, True if it changes
         """
-        if self.phase == FlightPhase.LAUNCHPAD:
-            self.phase = FlightPhase.INITIAL_CLIMB
-            return True
-        if self.phase == FlightPhase.INITIAL_CLIMB and altitude > 100:
-            self.phase = FlightPhase.INITIAL_TURN
-            return True
-        if self.phase == FlightPhase.INITIAL_TURN and altitude > 500:
-            self.phase = FlightPhase.GRAVITY_TURN
-            return True
-        if self.phase == FlightPhase.GRAVITY_TURN and self.telemetry.vessel.thrust < 1:
-            self.phase = FlightPhase.MECO
-            self.meco_timer_1 = Timer(0.5)
-            return True
-        if self.phase == FlightPhase.MECO and self.meco_timer_1.elapsed():
-            self.phase = FlightPhase.MAIN_STAGE_SEPARATION
-            self.meco_timer_2 = Timer(0.5)
-            return True
-        if self.phase == FlightPhase.MAIN_STAGE_SEPARATION and self.meco_timer_2.elapsed():
-            self.phase = FlightPhase.SUBORBITAL_ACCELERATION
-            return True
-        if self.phase == FlightPhase.SUBORBITAL_ACCELERATION and apoapsis > 75000:
-            self.phase = FlightPhase.SECO
-            return True
-        if self.phase == FlightPhase.SECO and altitude > 70000:
-            self.phase = FlightPhase.IN_SPACE_TOWARDS_CIRCULARIZATION
+        transition = self._transitions.get(self.phase)
+        if transition is None:
+            return False
+        condition, next_phase = transition
+        if condition(altitude, apoapsis):
+            self.phase = next_phase
             return True
         return False
 
     def _change_flight_law(self):
         control = self.telemetry.vessel.control
         autopilot = self.telemetry.autopilot
-        full_elapsed_text = str(self.telemetry.elapsed)
-        dot_index = full_elapsed_text.find('.')
-        elapsed_text = full_elapsed_text[0:dot_index+3]
-
-        print(elapsed_text, ' | ', self.phase_name)
+        self.telemetry.log(f'{self.telemetry.elapsed:.2f}', ' | ', self.phase_name)
 
         if self.phase == FlightPhase.LAUNCHPAD:
             control.sas = False
@@ -192,9 +285,11 @@ class OrbitalLaunch:
 
         if self.phase == FlightPhase.MECO:
             control.throttle = 0
+            self.meco_timer_1 = Timer(0.5)
 
         if self.phase == FlightPhase.MAIN_STAGE_SEPARATION:
             control.activate_next_stage()
+            self.meco_timer_2 = Timer(0.5)
 
         if self.phase == FlightPhase.SUBORBITAL_ACCELERATION:
             control.activate_next_stage()
@@ -209,5 +304,5 @@ class OrbitalLaunch:
 
 if __name__ == '__main__':
     launch = OrbitalLaunch()
-    launch.telemetry.do_record = True
+    launch.telemetry.start_recording()
     launch.run()